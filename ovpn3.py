@@ -1,61 +1,212 @@
 #!/usr/bin/python3
+from __future__ import annotations
+
 import base64
+import functools
 import logging
+import queue
+import threading
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from getpass import getpass
+from typing import TYPE_CHECKING, NamedTuple, Optional
 
 import backoff as backoff
 import click
 import click_log
-import dbus
-import keyring
-import openvpn3
-from cryptography.hazmat.primitives.hashes import SHA1
-from cryptography.hazmat.primitives.twofactor.totp import TOTP
-from cryptography.hazmat.backends import default_backend
+
+# D-Bus, GI, OpenSSL and keyring backends are slow to import,
+# they are only loaded by the commands that talk to them
+if TYPE_CHECKING:
+    import dbus
+    import openvpn3
+    from cryptography.hazmat.primitives.twofactor.totp import TOTP
+
+__version__ = '0.1.3'
 
 log = logging.getLogger(__name__)
 click_log.basic_config(log)
 
+# Seconds shared by every wait in a single connect attempt
+CONNECT_TIMEOUT = 60
+
+# D-Bus errors that won't go away by waiting for the backend to start
+_GIVEUP_NAMES = frozenset(
+    {
+        'org.freedesktop.DBus.Error.AccessDenied',
+        'org.freedesktop.DBus.Error.UnknownMethod',
+    }
+)
+
+
+def _giveup(error) -> bool:
+    return error.get_dbus_name() in _GIVEUP_NAMES
+
+
+def _is_missing_credentials(error) -> bool:
+    # The error name differs between openvpn3 releases, the message does not
+    return (error.get_dbus_message() or '').endswith('Missing user credentials')
+
+
+class Credentials(NamedTuple):
+    username: str
+    password: Optional[str]
+    totp: Optional[TOTP]
+
+
+class InputSlot(NamedTuple):
+    type: int
+    group: int
+    id: int
+    label: str
+
 
 @dataclass(frozen=True)
 class CredentialsService:
     profile: str
     username: str
+    service_name: str = field(init=False)
 
-    @property
-    def service_name(self):
-        return f'openvpn-{self.profile}'
+    def __post_init__(self):
+        object.__setattr__(self, 'service_name', f'openvpn-{self.profile}')
 
     def save_password(self, password):
+        import keyring
+
         keyring.set_password(self.service_name, self.username, password)
 
     def get_password(self):
+        import keyring
+
         return keyring.get_password(self.service_name, self.username)
 
     def save_totp_key(self, key):
+        import keyring
+
         keyring.set_password(self.service_name, 'totp', key)
 
-    def get_totp_code(self):
+    @functools.cached_property
+    def totp(self) -> Optional[TOTP]:
+        import keyring
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.hashes import SHA1
+        from cryptography.hazmat.primitives.twofactor.totp import TOTP
+
+        # Keyring lookup and key decoding happen once, not on every MFA retry
         key = keyring.get_password(self.service_name, 'totp')
-        encoded_key = base64.b32decode(key, casefold=True)
-        totp = TOTP(
-            key=encoded_key,
+        if key is None:
+            return None
+
+        return TOTP(
+            key=base64.b32decode(key, casefold=True),
             length=6,
             algorithm=SHA1(),
             time_step=30,
             backend=default_backend(),
             enforce_key_length=False,
         )
-        return totp.generate(time.time())
+
+    def load(self) -> Credentials:
+        """Fetch everything needed for a connection from the keyring at once
+
+        Python strings can't be wiped, the secrets stay in memory
+        until the short-lived CLI process exits.
+        """
+        return Credentials(username=self.username, password=self.get_password(), totp=self.totp)
+
+
+@functools.lru_cache(maxsize=1)
+def _system_bus() -> dbus.SystemBus:
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop, threads_init
+    from gi.repository import GLib
+
+    threads_init()
+    DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+    # Replies and signals are dispatched from a daemon thread
+    # so the CLI can block on them without running the loop itself
+    threading.Thread(target=GLib.MainLoop().run, name='glib-mainloop', daemon=True).start()
+    return bus
+
+
+def _call_async(*calls):
+    """Send all D-Bus calls up-front and block until each one replies
+
+    Every call is a ``(method, *args)`` tuple. Replies are returned in order,
+    the first error is raised once all calls are answered.
+    """
+    if not calls:
+        return []
+
+    finished = threading.Event()
+    replies = [None] * len(calls)
+    errors = []
+    pending = len(calls)
+
+    def done():
+        nonlocal pending
+        pending -= 1
+        if pending == 0:
+            finished.set()
+
+    for index, (method, *args) in enumerate(calls):
+
+        def on_reply(*reply, index=index):
+            replies[index] = reply[0] if len(reply) == 1 else reply
+            done()
+
+        def on_error(error):
+            errors.append(error)
+            done()
+
+        method(*args, reply_handler=on_reply, error_handler=on_error)
+
+    finished.wait()
+    if errors:
+        raise errors[0]
+    return replies
+
+
+def _settled_statuses() -> tuple:
+    """Minor statuses after which the backend won't ask for MFA anymore"""
+    import openvpn3
+
+    return (
+        openvpn3.StatusMinor.CONN_CONNECTED,
+        openvpn3.StatusMinor.CONN_FAILED,
+        openvpn3.StatusMinor.CONN_DONE,
+    )
+
+
+def _ended_attempt_statuses() -> tuple:
+    """Minor statuses that end an attempt, a dynamic challenge may still be pending"""
+    import openvpn3
+
+    return (
+        openvpn3.StatusMinor.CONN_AUTH_FAILED,
+        openvpn3.StatusMinor.CONN_DISCONNECTED,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _config_mgr() -> openvpn3.ConfigurationManager:
+    import openvpn3
+
+    return openvpn3.ConfigurationManager(_system_bus())
+
+
+@functools.lru_cache(maxsize=1)
+def _session_mgr() -> openvpn3.SessionManager:
+    import openvpn3
+
+    return openvpn3.SessionManager(_system_bus())
 
 
 class SessionProvider:
     def __init__(self) -> None:
-        bus: dbus.SystemBus = dbus.SystemBus()
-        self.configuration_manager = openvpn3.ConfigurationManager(bus)
-        self.session_manager = openvpn3.SessionManager(bus)
+        self.configuration_manager = _config_mgr()
+        self.session_manager = _session_mgr()
 
     def __call__(self, profile: str):
         session = self.get_session(profile)
@@ -87,94 +238,266 @@ class SessionProvider:
 
 class VPN:
     def __init__(self, profile: str) -> None:
+        import dbus
+
+        self.profile = profile
         self.session = SessionProvider()(profile=profile)
+        session_object = _system_bus().get_object(
+            'net.openvpn.v3.sessions', self.session.GetPath(), introspect=False
+        )
+        self.proxy = dbus.Interface(session_object, dbus_interface='net.openvpn.v3.sessions')
+        self.properties = dbus.Interface(session_object, dbus_interface=dbus.PROPERTIES_IFACE)
+        self._deadline = None
+        self.status_changes = queue.Queue()
+        _system_bus().add_signal_receiver(
+            self.on_status_change,
+            signal_name='StatusChange',
+            dbus_interface='net.openvpn.v3.backends',
+            path=self.session.GetPath(),
+        )
+        self.session.LogForward(True)
+
+    def on_status_change(self, major, minor, message):
+        import openvpn3
+
+        status = (openvpn3.StatusMajor(major), openvpn3.StatusMinor(minor))
+        log.debug("Status change: %s %s", status, message)
+        self.status_changes.put(status)
+
+    def drain_status_changes(self):
+        """Forget signals from earlier steps so they can't satisfy a later wait"""
+        while True:
+            try:
+                self.status_changes.get_nowait()
+            except queue.Empty:
+                return
+
+    def wait_for_status(self, *minors, timeout: float):
+        """Block until the backend reaches one of the given minor statuses
+
+        The status is polled once up-front, in case it already got there,
+        and once more before ``queue.Empty`` is raised. In between only
+        signals are awaited.
+        """
+        deadline = time.monotonic() + timeout
+        minor = self.check_status()['minor']
+        while minor not in minors:
+            try:
+                major, minor = self.status_changes.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                minor = self.check_status()['minor']
+                if minor not in minors:
+                    raise
+        return minor
+
+    def remaining(self) -> float:
+        """Seconds left of the current connect budget, or a full budget outside of connect"""
+        if self._deadline is None:
+            return CONNECT_TIMEOUT
+        return max(self._deadline - time.monotonic(), 0)
+
+    def prompt(self, label: str) -> str:
+        """Ask the user for input, time spent typing is not taken from the connect budget"""
+        started = time.monotonic()
+        try:
+            return input(f'{label}: ')
+        finally:
+            if self._deadline is not None:
+                self._deadline += time.monotonic() - started
 
-    @backoff.on_exception(
-        wait_gen=backoff.expo,
-        exception=dbus.exceptions.DBusException,
-        max_tries=8,
-    )
     def check_status(self):
-        status = self.session.GetStatus()
+        import dbus
+
+        # Wrapped per call so max_time is bound to this instance's deadline
+        retry = backoff.on_exception(
+            wait_gen=backoff.expo,
+            exception=dbus.exceptions.DBusException,
+            max_time=self.remaining,
+            jitter=backoff.full_jitter,
+            giveup=_giveup,
+        )
+        return retry(self.get_status)()
+
+    def get_status(self):
+        import openvpn3
+
+        ((major, minor, message),) = _call_async(
+            (self.properties.Get, 'net.openvpn.v3.sessions', 'status'),
+        )
+        status = {
+            'major': openvpn3.StatusMajor(major),
+            'minor': openvpn3.StatusMinor(minor),
+            'message': str(message),
+        }
         log.debug("Status: %s", status)
         return status
 
-    def authenticate(self, credentials_service: CredentialsService):
-        slots = self.session.FetchUserInputSlots()
+    def fetch_input_slots(self) -> dict[str, InputSlot]:
+        """Index pending user input slots by variable name
+
+        Each level of the input queue is requested in a single pipelined batch.
+        """
+        (type_groups,) = _call_async((self.proxy.UserInputQueueGetTypeGroup,))
+        checks = _call_async(
+            *((self.proxy.UserInputQueueCheck, type_, group) for type_, group in type_groups)
+        )
+        slots = _call_async(
+            *(
+                (self.proxy.UserInputQueueFetch, type_, group, slot_id)
+                for (type_, group), slot_ids in zip(type_groups, checks)
+                for slot_id in slot_ids
+            )
+        )
         log.debug("Input slots: %s", slots)
-        for slot in slots:
-            log.debug("Slot: %s", slot)
-            variable_name = slot.GetVariableName()
-            if variable_name == 'username':
-                username = credentials_service.username
-                log.info(f'Sending user: {username}')
-                slot.ProvideInput(username)
-
-            if variable_name == 'password':
-                log.info(f'Sending password: ***')
-                password = credentials_service.get_password()
-                slot.ProvideInput(password)
-
-    @backoff.on_predicate(wait_gen=backoff.expo, max_tries=8)
-    def mfa(self, credentials_service: CredentialsService):
-        self.check_status()
-        slots = self.session.FetchUserInputSlots()
-        log.debug("Slots: %s", slots)
-        if len(slots) < 1:
-            log.debug(f'MFA prompt not present')
-            return False
-
-        slot = slots[0]
-        log.debug("Slot: %s", slot)
-        code = credentials_service.get_totp_code()
-        if code is not None:
-            log.debug(f'Sending TOTP code {code}')
-            slot.ProvideInput(code)
-        else:
-            label = slot.GetLabel()
-            slot.ProvideInput(input(f'{label}: '))
+        return {
+            str(variable_name): InputSlot(type_, group, slot_id, str(label))
+            for type_, group, slot_id, variable_name, label, masked in slots
+        }
+
+    def provide_input(self, *inputs):
+        """Answer ``(slot, value)`` pairs in a single pipelined batch"""
+        _call_async(
+            *(
+                (self.proxy.UserInputProvide, slot.type, slot.group, slot.id, value)
+                for slot, value in inputs
+            )
+        )
 
-        return True
+    def authenticate(self, username: str, password: Optional[str]):
+        slots = self.fetch_input_slots()
 
-    @backoff.on_predicate(wait_gen=backoff.expo, max_tries=8)
-    def wait_for_connection(self):
-        status = self.check_status()
-        if status['minor'] == openvpn3.StatusMinor.CONN_AUTH_FAILED:
-            self.disconnect()
-            return True
+        inputs = []
+        if 'username' in slots:
+            log.info(f'Sending user: {username}')
+            inputs.append((slots['username'], username))
+
+        if 'password' in slots:
+            if password is None:
+                log.info(f"Please store a password:\novpn3 setup {self.profile} {username}")
+                raise Exception(f'Missing password for {username}')
 
-        if status['minor'] == openvpn3.StatusMinor.CONN_CONNECTED:
-            log.info("Connected...")
-            return True
+            log.info(f'Sending password: ***')
+            inputs.append((slots['password'], password))
 
-    def connect(self, credentials_service: CredentialsService):
-        self.check_status()
+        self.provide_input(*inputs)
+
+    def wait_for_mfa_prompt(self):
+        import openvpn3
+
+        try:
+            return self.wait_for_status(
+                openvpn3.StatusMinor.CFG_REQUIRE_USER,
+                *_settled_statuses(),
+                *_ended_attempt_statuses(),
+                timeout=self.remaining(),
+            )
+        except queue.Empty:
+            # The backend never asked, look for a challenge slot anyway
+            return openvpn3.StatusMinor.CFG_REQUIRE_USER
+
+    def mfa(self, totp: Optional[TOTP]) -> Optional[openvpn3.StatusMinor]:
+        """Answer the MFA challenge if the backend presents one
+
+        Returns the minor status the connection already settled in,
+        or ``None`` if it still has to be brought up.
+        """
+        # Returns at once if the backend is already past the prompt
+        minor = self.wait_for_mfa_prompt()
+        if minor in _settled_statuses():
+            log.debug("MFA not required, status: %s", minor)
+            return minor
+
+        if minor in _ended_attempt_statuses():
+            # A dynamic challenge ends the first attempt, look for it before giving up
+            slots = self.fetch_input_slots()
+            if len(slots) < 1:
+                return minor
+        else:
+            # The challenge slot may show up a moment after the signal
+            retry = backoff.on_predicate(
+                wait_gen=backoff.expo,
+                max_value=5,
+                factor=0.5,
+                max_time=self.remaining,
+            )
+            slots = retry(self.fetch_input_slots)()
+            if len(slots) < 1:
+                log.debug(f'MFA prompt not present')
+                return None
 
+        slot = next(iter(slots.values()))
+        log.debug("Slot: %s", slot)
+        if totp is not None:
+            code = totp.generate(time.time()).decode()
+            log.debug(f'Sending TOTP code {code}')
+            self.provide_input((slot, code))
+        else:
+            self.provide_input((slot, self.prompt(slot.label)))
+
+    def wait_for_connection(self) -> openvpn3.StatusMinor:
+        import openvpn3
+
+        auth_failed = openvpn3.StatusMinor.CONN_AUTH_FAILED
+        while True:
+            try:
+                # The status is re-read before giving up, a tunnel that came up is kept
+                minor = self.wait_for_status(
+                    *_settled_statuses(), auth_failed, timeout=self.remaining()
+                )
+            except queue.Empty:
+                raise Exception('Timed out waiting for connection')
+
+            # The attempt that raised the challenge may report its teardown late
+            if minor != auth_failed or self.check_status()['minor'] == auth_failed:
+                return minor
+
+    def connect(self, credentials: Credentials):
+        import dbus
+        import openvpn3
+
+        # A stage that finishes quickly leaves its time to the slower ones
+        self._deadline = time.monotonic() + CONNECT_TIMEOUT
         try:
             # Wait for the backends to settle
             # The GetStatus() method will throw an exception
             # if the backend is not yet ready
-            self.session.Ready()
-        except dbus.exceptions.DBusException as e:
-            if not str(e).endswith('Missing user credentials'):
-                raise e
-
             self.check_status()
-            self.authenticate(credentials_service=credentials_service)
 
-        self.check_status()
-        self.session.Ready()
-        self.session.Connect()
+            try:
+                _call_async((self.proxy.Ready,))
+            except dbus.exceptions.DBusException as e:
+                if not _is_missing_credentials(e):
+                    raise e
+
+                self.authenticate(username=credentials.username, password=credentials.password)
+
+            # Progress from here on is gated by Ready replies and StatusChange signals
+            self.ready_and_connect()
+            minor = self.mfa(totp=credentials.totp)
+            if minor is None:
+                self.ready_and_connect()
+                minor = self.wait_for_connection()
+        finally:
+            self._deadline = None
+
+        if minor == openvpn3.StatusMinor.CONN_AUTH_FAILED:
+            self.disconnect()
+            return
+
+        if minor != openvpn3.StatusMinor.CONN_CONNECTED:
+            raise Exception(f'Connection ended: {minor}')
 
-        self.check_status()
-        self.mfa(credentials_service=credentials_service)
+        log.info("Connected...")
 
-        self.session.Ready()
-        self.session.Connect()
-        self.wait_for_connection()
+    def ready_and_connect(self):
+        # Drained before the call, not before the wait, so signals it triggers are kept
+        self.drain_status_changes()
+        # Connect must never follow a Ready that failed
+        _call_async((self.proxy.Ready,))
+        _call_async((self.proxy.Connect,))
 
     def disconnect(self):
-        self.check_status()
+        # Session is already resolved, Disconnect is the only round-trip needed
         self.session.Disconnect()
 
 
@@ -205,10 +528,10 @@ def setup(ctx, username, profile):
 @click.pass_context
 def connect(ctx, username, profile):
     """Connect VPN session"""
-    credentials_service = CredentialsService(profile, username)
+    credentials = CredentialsService(profile, username).load()
     vpn = VPN(profile=profile)
     try:
-        vpn.connect(credentials_service=credentials_service)
+        vpn.connect(credentials=credentials)
     except Exception as ex:
         vpn.disconnect()
         raise ex
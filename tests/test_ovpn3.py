@@ -1,5 +1,321 @@
+import enum
+import queue
+import sys
+import time
+import types
+
+import pytest
+
+import ovpn3
 from ovpn3 import __version__
 
 
 def test_version():
     assert __version__ == '0.1.3'
+
+
+class Method:
+    """Fake async D-Bus method, replies right away like a fast backend"""
+
+    def __init__(self, *reply, error=None):
+        self.reply = reply
+        self.error = error
+        self.calls = []
+
+    def __call__(self, *args, reply_handler, error_handler):
+        self.calls.append(args)
+        if self.error is not None:
+            error_handler(self.error)
+        else:
+            reply_handler(*self.reply)
+
+
+def test_call_async_returns_replies_in_order():
+    replies = ovpn3._call_async((Method('first'), 1), (Method(1, 2), 2), (Method(),))
+    assert replies == ['first', (1, 2), ()]
+
+
+def test_call_async_sends_arguments():
+    method = Method(None)
+    ovpn3._call_async((method, 'a', 'b'))
+    assert method.calls == [('a', 'b')]
+
+
+def test_call_async_raises_first_error_after_all_replies():
+    error = RuntimeError('boom')
+    later = Method('ok')
+    with pytest.raises(RuntimeError) as excinfo:
+        ovpn3._call_async((Method(error=error),), (Method(error=ValueError()),), (later,))
+    assert excinfo.value is error
+    assert later.calls == [()]
+
+
+def test_call_async_without_calls():
+    assert ovpn3._call_async() == []
+
+
+def make_vpn(statuses=()):
+    vpn = ovpn3.VPN.__new__(ovpn3.VPN)
+    vpn._deadline = None
+    vpn.status_changes = queue.Queue()
+    vpn.polls = 0
+    polled = iter(statuses)
+
+    def check_status():
+        vpn.polls += 1
+        return {'minor': next(polled)}
+
+    vpn.check_status = check_status
+    return vpn
+
+
+def test_wait_for_status_returns_signalled_status_without_polling_in_between():
+    vpn = make_vpn(statuses=['other'])
+    vpn.status_changes.put(('major', 'other'))
+    vpn.status_changes.put(('major', 'wanted'))
+    assert vpn.wait_for_status('wanted', timeout=1) == 'wanted'
+    assert vpn.polls == 1
+
+
+def test_wait_for_status_returns_status_already_reached():
+    vpn = make_vpn(statuses=['wanted'])
+    assert vpn.wait_for_status('wanted', timeout=1) == 'wanted'
+    assert vpn.polls == 1
+
+
+def test_wait_for_status_polls_before_timing_out():
+    vpn = make_vpn(statuses=['other', 'wanted'])
+    assert vpn.wait_for_status('wanted', timeout=0.05) == 'wanted'
+    assert vpn.polls == 2
+
+
+def test_wait_for_status_times_out_after_final_poll():
+    vpn = make_vpn(statuses=['other', 'other'])
+    with pytest.raises(queue.Empty):
+        vpn.wait_for_status('wanted', timeout=0)
+
+
+def test_drain_status_changes():
+    vpn = make_vpn(statuses=['other', 'other'])
+    vpn.status_changes.put(('major', 'wanted'))
+    vpn.drain_status_changes()
+    with pytest.raises(queue.Empty):
+        vpn.wait_for_status('wanted', timeout=0)
+
+
+class Proxy:
+    """Fake session proxy serving a canned user input queue"""
+
+    def __init__(self, type_groups, checks, slots):
+        self.UserInputQueueGetTypeGroup = Method(type_groups)
+        self.UserInputProvide = Method(None)
+        self.checks = checks
+        self.slots = slots
+
+    def UserInputQueueCheck(self, type_, group, reply_handler, error_handler):
+        reply_handler(self.checks[(type_, group)])
+
+    def UserInputQueueFetch(self, type_, group, slot_id, reply_handler, error_handler):
+        reply_handler(*self.slots[(type_, group, slot_id)])
+
+
+def test_fetch_input_slots_indexes_by_variable_name():
+    vpn = make_vpn()
+    vpn.proxy = Proxy(
+        type_groups=[(1, 1), (2, 1)],
+        checks={(1, 1): [0, 1], (2, 1): []},
+        slots={
+            (1, 1, 0): (1, 1, 0, 'username', 'Auth Username', False),
+            (1, 1, 1): (1, 1, 1, 'password', 'Auth Password', True),
+        },
+    )
+    assert vpn.fetch_input_slots() == {
+        'username': ovpn3.InputSlot(1, 1, 0, 'Auth Username'),
+        'password': ovpn3.InputSlot(1, 1, 1, 'Auth Password'),
+    }
+
+
+def test_fetch_input_slots_with_empty_queue():
+    vpn = make_vpn()
+    vpn.proxy = Proxy(type_groups=[], checks={}, slots={})
+    assert vpn.fetch_input_slots() == {}
+
+
+class DBusException(Exception):
+    """Fake of the dbus-python exception accessors"""
+
+    def __init__(self, name, message=None):
+        super().__init__(message)
+        self.name = name
+        self.message = message
+
+    def get_dbus_name(self):
+        return self.name
+
+    def get_dbus_message(self):
+        return self.message
+
+
+@pytest.mark.parametrize(
+    'name', ['net.openvpn.v3.sessions.error', 'net.openvpn.v3.error.ready', 'anything.else']
+)
+def test_missing_credentials_matched_by_message(name):
+    error = DBusException(name, 'Backend VPN process is not ready: Missing user credentials')
+    assert ovpn3._is_missing_credentials(error)
+
+
+def test_other_errors_are_not_missing_credentials():
+    assert not ovpn3._is_missing_credentials(DBusException('net.openvpn.v3.error.ready'))
+    assert not ovpn3._is_missing_credentials(
+        DBusException('net.openvpn.v3.sessions.error', 'Backend VPN process is not ready')
+    )
+
+
+@pytest.mark.parametrize(
+    'name', ['org.freedesktop.DBus.Error.AccessDenied', 'org.freedesktop.DBus.Error.UnknownMethod']
+)
+def test_giveup_on_permanent_errors(name):
+    assert ovpn3._giveup(DBusException(name))
+
+
+@pytest.mark.parametrize(
+    'name',
+    [
+        'net.openvpn.v3.sessions.error',
+        'net.openvpn.v3.error.ready',
+        'org.freedesktop.DBus.Error.NoReply',
+        'org.freedesktop.DBus.Error.ServiceUnknown',
+    ],
+)
+def test_retry_on_startup_errors(name):
+    assert not ovpn3._giveup(DBusException(name))
+
+
+def username_only_proxy():
+    return Proxy(
+        type_groups=[(1, 1)],
+        checks={(1, 1): [0]},
+        slots={(1, 1, 0): (1, 1, 0, 'username', 'Auth Username', False)},
+    )
+
+
+def test_authenticate_without_password_slot_needs_no_password():
+    vpn = make_vpn()
+    vpn.proxy = username_only_proxy()
+    vpn.authenticate(username='user', password=None)
+    assert vpn.proxy.UserInputProvide.calls == [(1, 1, 0, 'user')]
+
+
+def test_authenticate_requires_password_for_password_slot():
+    vpn = make_vpn()
+    vpn.profile = 'profile'
+    vpn.proxy = Proxy(
+        type_groups=[(1, 1)],
+        checks={(1, 1): [0]},
+        slots={(1, 1, 0): (1, 1, 0, 'password', 'Auth Password', True)},
+    )
+    with pytest.raises(Exception, match='Missing password for user'):
+        vpn.authenticate(username='user', password=None)
+    assert vpn.proxy.UserInputProvide.calls == []
+
+
+class StatusMinor(enum.Enum):
+    CFG_REQUIRE_USER = 5
+    CONN_CONNECTED = 7
+    CONN_DISCONNECTED = 9
+    CONN_FAILED = 10
+    CONN_AUTH_FAILED = 11
+    CONN_DONE = 16
+
+
+@pytest.fixture
+def openvpn3(monkeypatch):
+    module = types.ModuleType('openvpn3')
+    module.StatusMinor = StatusMinor
+    monkeypatch.setitem(sys.modules, 'openvpn3', module)
+    return module
+
+
+def challenge_proxy():
+    return Proxy(
+        type_groups=[(1, 2)],
+        checks={(1, 2): [3]},
+        slots={(1, 2, 3): (1, 2, 3, 'dynamic_challenge', 'Enter code', False)},
+    )
+
+
+@pytest.mark.parametrize(
+    'minor', [StatusMinor.CONN_CONNECTED, StatusMinor.CONN_FAILED, StatusMinor.CONN_DONE]
+)
+def test_mfa_short_circuits_when_settled(openvpn3, minor):
+    vpn = make_vpn(statuses=[minor])
+    vpn.proxy = None  # any input queue access would fail
+    assert vpn.mfa(totp=None) is minor
+
+
+@pytest.mark.parametrize('minor', [StatusMinor.CONN_AUTH_FAILED, StatusMinor.CONN_DISCONNECTED])
+def test_mfa_answers_challenge_pending_after_ended_attempt(openvpn3, monkeypatch, minor):
+    vpn = make_vpn(statuses=[minor])
+    vpn.proxy = challenge_proxy()
+    monkeypatch.setattr('builtins.input', lambda prompt: '123456')
+    assert vpn.mfa(totp=None) is None
+    assert vpn.proxy.UserInputProvide.calls == [(1, 2, 3, '123456')]
+
+
+def test_mfa_reports_ended_attempt_without_challenge(openvpn3):
+    vpn = make_vpn(statuses=[StatusMinor.CONN_DISCONNECTED])
+    vpn.proxy = Proxy(type_groups=[], checks={}, slots={})
+    assert vpn.mfa(totp=None) is StatusMinor.CONN_DISCONNECTED
+
+
+def test_wait_for_connection_ignores_stale_auth_failure(openvpn3):
+    vpn = make_vpn(
+        statuses=[
+            StatusMinor.CFG_REQUIRE_USER,
+            StatusMinor.CONN_CONNECTED,
+            StatusMinor.CONN_CONNECTED,
+        ]
+    )
+    vpn._deadline = time.monotonic() + 0.2
+    vpn.status_changes.put(('major', StatusMinor.CONN_AUTH_FAILED))
+    assert vpn.wait_for_connection() is StatusMinor.CONN_CONNECTED
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_remaining_is_full_budget_outside_connect():
+    assert make_vpn().remaining() == ovpn3.CONNECT_TIMEOUT
+
+
+def test_remaining_is_shared_across_stages(clock):
+    vpn = make_vpn()
+    vpn._deadline = clock[0] + ovpn3.CONNECT_TIMEOUT
+    clock[0] += 20  # a slow first stage
+    assert vpn.remaining() == ovpn3.CONNECT_TIMEOUT - 20
+    clock[0] += 30  # the next stage only gets what is left
+    assert vpn.remaining() == ovpn3.CONNECT_TIMEOUT - 50
+
+
+def test_remaining_is_clamped_at_zero(clock):
+    vpn = make_vpn()
+    vpn._deadline = clock[0] + 1
+    clock[0] += 5
+    assert vpn.remaining() == 0
+
+
+def test_prompt_does_not_spend_budget(clock, monkeypatch):
+    vpn = make_vpn()
+    vpn._deadline = clock[0] + 10
+
+    def slow_typist(prompt):
+        clock[0] += 120
+        return '123456'
+
+    monkeypatch.setattr('builtins.input', slow_typist)
+    assert vpn.prompt('Enter code') == '123456'
+    assert vpn.remaining() == 10